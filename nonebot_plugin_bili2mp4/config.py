@@ -9,3 +9,7 @@ class Config(BaseModel):
         default=None,
         description="FFmpeg可执行文件所在目录路径，不是ffmpeg文件本身的路径",
     )
+    ffmpeg_download: bool = Field(
+        default=False,
+        description="未安装aria2c时由ffmpeg直接拉流并封装，省去合并时的磁盘读写，但不支持重试和断点续传",
+    )
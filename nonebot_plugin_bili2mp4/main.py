@@ -1,18 +1,25 @@
 from __future__ import annotations
 
 import asyncio
+import copy
+import functools
+import hashlib
 import json
 import os
 import re
 import shutil
 import subprocess
+import tempfile
 import time
-import urllib.request
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import List, Optional, Set, Tuple, Dict, Union
+from typing import List, Optional, Set, Tuple, Dict, Union, Iterator
 from urllib.parse import parse_qs, unquote, urlparse
 
-from nonebot import logger, on_message, require
+import aiohttp
+from nonebot import get_driver, logger, on_message, require
 from nonebot.adapters.onebot.v11 import (
     Bot,
     Event,
@@ -28,6 +35,20 @@ import nonebot_plugin_localstore as store
 
 from .config import Config
 
+try:
+    import orjson  # 可选依赖，加速 JSON 读写
+except ImportError:
+    orjson = None
+
+try:
+    import re2  # 可选依赖，线性时间（无回溯）的正则引擎，用于扫描群消息
+except ImportError:
+    re2 = None
+
+# 群消息中的链接扫描优先用 re2。re2 的 \b \w \s \d 只认 ASCII，标准库 re 则按 Unicode，
+# 因此交给 _scan_re 的模式只用显式字符类和内联 (?i)，保证装不装 re2 结果都一致
+_scan_re = re2 if re2 is not None else re
+
 PLUGIN_NAME = "nonebot_plugin_bili2mp4"
 DATA_DIR: Optional[Path] = None
 STATE_PATH: Optional[Path] = None
@@ -43,8 +64,12 @@ bili_super_admins: List[int] = []
 
 # 映射路径 -> 真实路径 映射，例如 "/bilivideo" -> "C:\\...\\downloads"
 path_mappings: Dict[str, str] = {}
+# 由 path_mappings 派生的查找表：(已 resolve 的真实路径, 映射路径)，按真实路径长度降序，
+# 保证最长前缀优先匹配；path_mappings 每次修改后需调用 _rebuild_mapping_index
+_mapping_index: List[Tuple[str, str]] = []
 
 _BILI_TABLE = list("FcwAPNKTMug3GV5Lj7EJnHpWsx4tb8haYeviqBz6rkCy12mUSDQX9RdoZf")
+_BILI_TABLE_B = "".join(_BILI_TABLE).encode()
 _BILI_REV_TABLE = {alpha: idx for idx, alpha in enumerate(_BILI_TABLE)}
 _BILI_MAX_AVID = 1 << 51          # 2^51
 _BILI_MIN_AVID = 1
@@ -52,47 +77,187 @@ _BILI_XOR_CODE = 23442827791579
 _BILI_MASK_CODE = 2251799813685247
 _BILI_BASE = 58
 
-_processing: Set[str] = set()
+# 键（视频 URL 等）-> 锁，以及当前持有/等待该锁的任务数（归零时回收）
+_url_locks: Dict[str, asyncio.Lock] = {}
+_url_lock_users: Dict[str, int] = {}
 
 FFMPEG_DIR: Optional[str] = None
+FFMPEG_EXE = "ffmpeg.exe" if os.name == "nt" else "ffmpeg"
+FFPROBE_EXE = "ffprobe.exe" if os.name == "nt" else "ffprobe"
+ARIA2C_PATH: Optional[str] = None
+# 是否由 ffmpeg 直接拉流下载（见配置项 ffmpeg_download）
+FFMPEG_DOWNLOAD = False
+
+# 同时运行的 yt-dlp 任务（下载 + ffmpeg 合并）上限，信号量在事件循环内惰性创建
+MAX_CONCURRENT_JOBS = max(2, (os.cpu_count() or 2) // 2)
+_job_sem: Optional[asyncio.Semaphore] = None
+# 每个群同时处理的视频数，避免一条刷屏消息占满全局名额、饿死其他群
+MAX_JOBS_PER_GROUP = 1
+_group_sems: Dict[int, asyncio.Semaphore] = defaultdict(
+    lambda: asyncio.Semaphore(MAX_JOBS_PER_GROUP)
+)
 
-CMD_LIST = {"查看转换列表", "查看列表", "转换列表"}
-CMD_ENABLE_RE = re.compile(r"^转换\s*(\d+)$", flags=re.IGNORECASE)
-CMD_DISABLE_RE = re.compile(r"^停止转换\s*(\d+)$", flags=re.IGNORECASE)
-CMD_SET_COOKIE_RE = re.compile(r"^设置B站COOKIE\s+(.+)$", flags=re.S)
-CMD_CLEAR_COOKIE = {"清除B站COOKIE", "删除B站COOKIE"}
-CMD_SET_HEIGHT_RE = re.compile(r"^设置清晰度\s*(\d+)$", flags=re.IGNORECASE)
-CMD_SET_MAXSIZE_RE = re.compile(r"^设置最大大小\s*(\d+)\s*MB$", flags=re.IGNORECASE)
-CMD_SET_MAXDUR_RE = re.compile(r"^设置最大时长\s*(\d+)\s*S$", flags=re.IGNORECASE)
-CMD_SHOW_PARAMS = {"查看参数", "参数", "设置"}
-
-# 映射命令
-CMD_SET_MAPPING_RE = re.compile(r"^映射路径\s+(\S+)\s+(.+)$", flags=re.IGNORECASE)
-CMD_REMOVE_MAPPING_RE = re.compile(r"^删除映射\s+(\S+)$", flags=re.IGNORECASE)
-CMD_LIST_MAPPINGS = {"查看映射", "映射列表"}
+# 专用于启动 ffprobe 等子进程的线程池，避免阻塞事件循环
+_spawn_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="ffspawn")
+
+# aria2c 分段下载的并发连接数（B站 CDN 支持 Range 请求）
+ARIA2C_SPLIT = 8
+
+# yt-dlp 内置下载器的初始读写块大小（默认从 1KiB 起逐步翻倍）
+YTDLP_BUFFER_SIZE = 1 << 20
+
+# state.json 延迟写入：合并短时间内的多次修改
+_STATE_FLUSH_DELAY = 0.5
+_state_dirty = False
+_flush_handle: Optional[asyncio.TimerHandle] = None
+_flush_task: Optional[asyncio.Future] = None
+# 上次写入（或读取）的 state.json 内容及其 mtime
+_last_state_payload: Optional[bytes] = None
+_last_state_mtime_ns: Optional[int] = None
+# 串行化 state.json 的写入，在事件循环内惰性创建
+_state_lock: Optional[asyncio.Lock] = None
+
+# view 接口响应缓存：bvid -> (过期时间, data)
+_VIEW_CACHE_TTL = 300
+_VIEW_CACHE_MAXSIZE = 1024
+_view_cache: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+
+# b23.tv 短链展开结果缓存：短链 -> 展开后的链接（仅缓存展开成功的结果）
+_SHORT_URL_CACHE_MAXSIZE = 1024
+_short_url_cache: "OrderedDict[str, str]" = OrderedDict()
+
+# 近期已受理的 (群号, 视频链接)：TTL 内同群重复分享的同一视频不再下载
+_RECENT_URL_TTL = 600
+_RECENT_URL_MAXSIZE = 1024
+_recent_urls: "OrderedDict[Tuple[int, str], float]" = OrderedDict()
+
+# 上次写入 cookie 文件时的 (Cookie 字符串摘要, mtime_ns, 文件大小)
+_last_cookie_state: Optional[Tuple[bytes, int, int]] = None
+# cookie 文件中写入的过期时间为 180 天，文件超过该时长未重写时刷新一次
+_COOKIE_REFRESH_AGE = 30 * 24 * 3600
+
+# 共享的 HTTP 会话（首次使用时在事件循环内创建）
+_http_session: Optional[aiohttp.ClientSession] = None
+
+# 私聊命令：所有命令合并为一个正则，一次匹配后按命中的命名分组分派处理函数
+_CMD_RE = re.compile(
+    r"(?:"
+    # 群相关
+    r"(?P<enable>转换\s*(?P<enable_gid>\d+))"
+    r"|(?P<disable>停止转换\s*(?P<disable_gid>\d+))"
+    r"|(?P<list>查看转换列表|查看列表|转换列表)"
+    # 配置相关
+    r"|(?P<set_cookie>设置B站COOKIE\s+(?P<cookie>.+))"
+    r"|(?P<clear_cookie>清除B站COOKIE|删除B站COOKIE)"
+    r"|(?P<set_height>设置清晰度\s*(?P<height>\d+))"
+    r"|(?P<set_maxsize>设置最大大小\s*(?P<maxsize>\d+)\s*(?i:MB))"
+    r"|(?P<set_maxdur>设置最大时长\s*(?P<maxdur>\d+)\s*(?i:S))"
+    r"|(?P<show_params>查看参数|参数|设置)"
+    # 映射命令
+    r"|(?P<set_mapping>映射路径\s+(?P<map_virt>\S+)\s+(?P<map_real>(?-s:.+)))"
+    r"|(?P<remove_mapping>删除映射\s+(?P<rm_virt>\S+))"
+    r"|(?P<list_mappings>查看映射|映射列表)"
+    r")",
+    flags=re.S,
+)
+
+# 链接的结束字符：与 str.isspace() 相同的空白字符集（含全角空格）以及引号、尖括号
+_URL_STOP_CHARS = (
+    "\t\n\x0b\x0c\r\x1c-\x1f \x85\xa0\u1680\u2000-\u200a"
+    "\u2028\u2029\u202f\u205f\u3000\"'<>"
+)
 
 # 域名匹配
-BILI_URL_RE = re.compile(
-    r"(https?://(?:[\w-]+\.)?(?:bilibili\.com|b23\.tv)/[^\s\"'<>]+)",
-    flags=re.IGNORECASE,
+BILI_URL_RE = _scan_re.compile(
+    r"(?i)(https?://(?:[0-9A-Za-z_-]+\.)?(?:bilibili\.com|b23\.tv)/[^" + _URL_STOP_CHARS + r"]+)"
+)
+# 群消息热路径上直接调用绑定方法
+_bili_url_findall = BILI_URL_RE.findall
+
+# 不可能携带链接的消息段类型
+_NO_URL_SEG_TYPES = frozenset(
+    {"image", "face", "mface", "at", "record", "video", "file", "poke", "dice", "rps", "shake", "reply", "forward", "node"}
 )
 
+# 外层跳转链接中可能携带 B 站链接的 query 参数名
+_QUERY_URL_KEYS = ("url", "qqdocurl", "jumpUrl", "webpageUrl")
+_QUERY_URL_MARKERS = tuple(k + "=" for k in _QUERY_URL_KEYS)
+
+# JSON 卡片解析的长度上限，超出时仅对原文做正则扫描
+MAX_CARD_JSON_LEN = 256 * 1024
+
+# AV / BV 号匹配
+# \b 在 re2 中只认 ASCII 单词字符，无法与标准库一致，该模式固定使用 re
+AV_BARE_RE = re.compile(r"\bav(\d+)\b", flags=re.IGNORECASE)
+AV_URL_RE = _scan_re.compile(r"(?i)https?://[^" + _URL_STOP_CHARS + r"]*/video/av([0-9]+)")
+AV_ID_RE = re.compile(r"av(\d+)", flags=re.IGNORECASE)
+VIDEO_BV_PATH_RE = re.compile(r"/video/(BV[0-9A-Za-z]+)")
+VIDEO_AV_PATH_RE = re.compile(r"/video/av(\d+)", flags=re.IGNORECASE)
+DIGITS_RE = re.compile(r"(\d+)")
+
 
 # =========================
 # 初始化函数
 # =========================
 
 
+async def _run_in_thread(func, *args):
+    """在默认线程池中执行阻塞调用（asyncio.to_thread 需要 Python 3.9+）"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args))
+
+
+def _resolve_ffmpeg(cfg_path: Optional[str], path_env: str) -> Optional[str]:
+    """解析 FFmpeg 所在目录：优先使用配置路径，否则在 PATH 中查找"""
+    if cfg_path:
+        ffmpeg_dir = Path(cfg_path)
+        ffmpeg_bin = ffmpeg_dir / FFMPEG_EXE
+        if ffmpeg_bin.exists():
+            logger.info(f"bili2mp4: 使用配置中的ffmpeg目录: {ffmpeg_dir}")
+            return str(ffmpeg_dir)
+        logger.warning(
+            f"bili2mp4: 配置的ffmpeg目录不存在或无{FFMPEG_EXE}: {ffmpeg_bin}"
+        )
+        return None
+
+    ffmpeg_path = shutil.which("ffmpeg", path=path_env or None)
+    if ffmpeg_path:
+        logger.info(f"bili2mp4: 从PATH找到ffmpeg: {ffmpeg_path}")
+        return os.path.dirname(ffmpeg_path)
+    logger.info("bili2mp4: 未找到ffmpeg")
+    return None
+
+
+def _install_uvloop():
+    """POSIX 下若安装了 uvloop，则在驱动创建事件循环前切换事件循环策略"""
+    if os.name == "nt":
+        return
+    try:
+        asyncio.get_running_loop()
+        return  # 事件循环已在运行，切换策略不再生效
+    except RuntimeError:
+        pass
+    try:
+        import uvloop  # type: ignore
+    except ImportError:
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logger.info("bili2mp4: 已启用 uvloop 事件循环")
+
+
 def _init_plugin():
     global DATA_DIR, STATE_PATH, DOWNLOAD_DIR, COOKIE_FILE_PATH
-    global bili_super_admins, FFMPEG_DIR, path_mappings
+    global bili_super_admins, FFMPEG_DIR, ARIA2C_PATH, FFMPEG_DOWNLOAD, path_mappings
 
     if DATA_DIR is not None:
         return
 
+    _install_uvloop()
+
     # 读取插件配置
     plugin_config = get_plugin_config(Config)
     bili_super_admins = plugin_config.bili_super_admins or []
+    FFMPEG_DOWNLOAD = plugin_config.ffmpeg_download
 
     # 获取数据目录
     DATA_DIR = store.get_plugin_data_dir()
@@ -106,26 +271,14 @@ def _init_plugin():
     _load_state()
 
     # 解析FFmpeg路径
-    if plugin_config.ffmpeg_path:
-        ffmpeg_dir = Path(plugin_config.ffmpeg_path)
-        ffmpeg_exe = "ffmpeg.exe" if os.name == "nt" else "ffmpeg"
-        ffmpeg_bin = ffmpeg_dir / ffmpeg_exe
-        if ffmpeg_bin.exists():
-            FFMPEG_DIR = str(ffmpeg_dir)
-            logger.info(f"bili2mp4: 使用配置中的ffmpeg目录: {FFMPEG_DIR}")
-        else:
-            logger.warning(
-                f"bili2mp4: 配置的ffmpeg目录不存在或无{ffmpeg_exe}: {ffmpeg_bin}"
-            )
-            FFMPEG_DIR = None
-    else:
-        ffmpeg_path = shutil.which("ffmpeg")
-        if ffmpeg_path:
-            FFMPEG_DIR = os.path.dirname(ffmpeg_path)
-            logger.info(f"bili2mp4: 从PATH找到ffmpeg: {ffmpeg_path}")
-        else:
-            logger.info("bili2mp4: 未找到ffmpeg")
-            FFMPEG_DIR = None
+    FFMPEG_DIR = _resolve_ffmpeg(
+        plugin_config.ffmpeg_path, os.environ.get("PATH", "")
+    )
+
+    # 可选：aria2c 多连接分段下载
+    ARIA2C_PATH = shutil.which("aria2c")
+    if ARIA2C_PATH:
+        logger.info(f"bili2mp4: 从PATH找到aria2c，启用分段下载: {ARIA2C_PATH}")
 
     logger.info(f"bili2mp4: 初始化完成，超管={bili_super_admins}")
 
@@ -135,22 +288,131 @@ def _init_plugin():
 # =========================
 
 
-def _save_state():
-    if not STATE_PATH:
-        return
+def _json_dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(
+            obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+        )
+    return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+
+
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+
+def _dump_state() -> bytes:
     data = {
-        "enabled_groups": list(enabled_groups),
+        "enabled_groups": sorted(enabled_groups),
         "bilibili_cookie": bilibili_cookie,
         "max_height": max_height,
         "max_filesize_mb": max_filesize_mb,
         "max_duration_sec": max_duration_sec,
         "path_mappings": path_mappings,
     }
+    return _json_dumps(data)
+
+
+def _remember_state_file(payload: bytes, mtime_ns: int) -> None:
+    """记录磁盘上 state.json 的内容与 mtime，供下次写入前比对（仅在事件循环线程调用）"""
+    global _last_state_payload, _last_state_mtime_ns
+    _last_state_payload = payload
+    _last_state_mtime_ns = mtime_ns
+
+
+def _write_state_file(
+    payload: bytes, last_payload: Optional[bytes], last_mtime_ns: Optional[int]
+) -> Optional[int]:
+    """
+    先写临时文件再替换，保证 state.json 不会写出半截内容。
+    返回写入后的 mtime；内容与上次一致且文件未被外部改动时跳过写入，返回 None。
+    """
+    if payload == last_payload:
+        try:
+            if STATE_PATH.stat().st_mtime_ns == last_mtime_ns:
+                return None
+        except OSError:
+            pass
+    # 每次写入使用独立的临时文件名，互不覆盖
+    fd, tmp = tempfile.mkstemp(
+        dir=str(STATE_PATH.parent), prefix=STATE_PATH.name + ".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+        os.replace(tmp, STATE_PATH)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    return STATE_PATH.stat().st_mtime_ns
+
+
+def _get_state_lock() -> asyncio.Lock:
+    global _state_lock
+    if _state_lock is None:
+        _state_lock = asyncio.Lock()
+    return _state_lock
+
+
+def _flush_state_sync() -> None:
+    global _state_dirty, _flush_handle
+    if _flush_handle is not None:
+        _flush_handle.cancel()
+        _flush_handle = None
+    if not _state_dirty or not STATE_PATH:
+        return
+    _state_dirty = False
+    payload = _dump_state()
     try:
-        with STATE_PATH.open("w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        mtime_ns = _write_state_file(payload, _last_state_payload, _last_state_mtime_ns)
     except Exception as e:
         logger.exception(f"bili2mp4: 保存状态失败: {e}")
+        return
+    if mtime_ns is not None:
+        _remember_state_file(payload, mtime_ns)
+
+
+async def _flush_state() -> None:
+    global _state_dirty
+    # 串行化写入：上一次写入完成前不开始下一次，避免旧内容后落盘
+    async with _get_state_lock():
+        if not _state_dirty or not STATE_PATH:
+            return
+        _state_dirty = False
+        # 在事件循环线程内序列化，拿到一致的状态快照
+        payload = _dump_state()
+        try:
+            mtime_ns = await _run_in_thread(
+                _write_state_file, payload, _last_state_payload, _last_state_mtime_ns
+            )
+        except Exception as e:
+            logger.exception(f"bili2mp4: 保存状态失败: {e}")
+            return
+        if mtime_ns is not None:
+            _remember_state_file(payload, mtime_ns)
+
+
+def _on_flush_timer() -> None:
+    global _flush_handle, _flush_task
+    _flush_handle = None
+    _flush_task = asyncio.ensure_future(_flush_state())
+
+
+def _save_state():
+    """标记状态已修改，短时间内的多次修改合并为一次写入"""
+    global _state_dirty, _flush_handle
+    if not STATE_PATH:
+        return
+    _state_dirty = True
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # 没有运行中的事件循环（如启动阶段）时直接同步写入
+        _flush_state_sync()
+        return
+    if _flush_handle is None:
+        _flush_handle = loop.call_later(_STATE_FLUSH_DELAY, _on_flush_timer)
 
 
 def _load_state():
@@ -160,8 +422,9 @@ def _load_state():
         return
 
     try:
-        with STATE_PATH.open("r", encoding="utf-8") as f:
-            data = json.load(f)
+        raw = STATE_PATH.read_bytes()
+        _remember_state_file(raw, STATE_PATH.stat().st_mtime_ns)
+        data = _json_loads(raw)
         enabled_groups = set(map(int, data.get("enabled_groups", [])))
         bilibili_cookie = data.get("bilibili_cookie", "")
         max_height = int(data.get("max_height", 0))
@@ -170,6 +433,38 @@ def _load_state():
         path_mappings = data.get("path_mappings", {}) or {}
     except Exception as e:
         logger.warning(f"bili2mp4: 状态加载失败: {e}")
+    _rebuild_mapping_index()
+
+
+def _build_mapping_index(mappings: Dict[str, str]) -> List[Tuple[str, str]]:
+    """构造映射查找表；真实路径在此一次性 resolve，发送时不再逐条访问文件系统"""
+    index: List[Tuple[str, str]] = []
+    for virt, real in mappings.items():
+        try:
+            real_p = str(Path(real).resolve())
+        except Exception:
+            real_p = real
+        index.append((real_p, virt))
+    index.sort(key=lambda it: len(it[0]), reverse=True)
+    return index
+
+
+def _rebuild_mapping_index() -> None:
+    global _mapping_index
+    _mapping_index = _build_mapping_index(path_mappings)
+
+
+async def _rebuild_mapping_index_async() -> None:
+    """在线程中 resolve 各路径（可能访问慢速或网络磁盘），不阻塞事件循环"""
+    global _mapping_index
+    while True:
+        snapshot = dict(path_mappings)
+        index = await _run_in_thread(_build_mapping_index, snapshot)
+        # 等待期间映射可能又被其他命令修改：只安装与当前映射一致的结果，否则重建，
+        # 这样先开始、后完成的旧快照不会覆盖掉新的映射
+        if snapshot == path_mappings:
+            _mapping_index = index
+            return
 
 
 def _get_help_message() -> str:
@@ -193,26 +488,48 @@ def _get_help_message() -> str:
     )
 
 
-def _find_urls_in_text(text: str) -> List[str]:
-    urls = []
-    for m in BILI_URL_RE.findall(text or ""):
-        if m not in urls:
-            urls.append(m)
+def _has_bili_marker(text: str) -> bool:
+    """BILI_URL_RE 能命中的文本必然包含这些子串，先做廉价的子串预检"""
+    tl = text.lower()
+    return "bilibili" in tl or "b23.tv" in tl
+
+
+def _find_urls_in_text_into(text: str, accum: Dict[str, None]) -> None:
+    """将文本中找到的 B 站链接按首次出现顺序写入 accum（dict 充当有序集合）"""
+    t = text or ""
+    # 百分号编码不会改写域名中的字母和点，编码后的链接同样带有这些子串，
+    # 因此不含标记的文本（绝大多数聊天内容）可以连同下面的慢路径一起跳过
+    if not _has_bili_marker(t):
+        return
+    for m in _bili_url_findall(t):
+        accum.setdefault(m, None)
+    # 慢路径：链接作为参数包在外层 URL 的 query 里（如小程序跳转链接）。
+    # 无论是否百分号编码都需解析 query：未编码时正则会把外层的 &from=... 一并吞进链接，
+    # 只有 parse_qs 才能切出干净的内层链接；不含这些参数名时直接跳过
+    if "?" not in t or not any(k in t for k in _QUERY_URL_MARKERS):
+        return
     try:
-        parsed = urlparse(text)
+        parsed = urlparse(t)
         if parsed and parsed.query:
             qs = parse_qs(parsed.query)
-            for key in ("url", "qqdocurl", "jumpUrl", "webpageUrl"):
+            for key in _QUERY_URL_KEYS:
                 for v in qs.get(key, []):
                     v = unquote(v)
-                    for u in BILI_URL_RE.findall(v):
-                        if u not in urls:
-                            urls.append(u)
+                    if not _has_bili_marker(v):
+                        continue
+                    for u in _bili_url_findall(v):
+                        accum.setdefault(u, None)
     except Exception:
         pass
-    return urls
 
 
+def _find_urls_in_text(text: str) -> List[str]:
+    seen: Dict[str, None] = {}
+    _find_urls_in_text_into(text, seen)
+    return list(seen)
+
+
+@functools.lru_cache(maxsize=4096)
 def _extract_bvid_from_url(url: str) -> Optional[str]:
     """从 B 站链接中提取 BV 号"""
     try:
@@ -224,7 +541,7 @@ def _extract_bvid_from_url(url: str) -> Optional[str]:
             return bvid_list[0]
 
         # 2) 再从 path 中匹配 /video/BVxxxx
-        m = re.search(r"/video/(BV[0-9A-Za-z]+)", parsed.path)
+        m = VIDEO_BV_PATH_RE.search(parsed.path)
         if m:
             return m.group(1)
 
@@ -233,111 +550,98 @@ def _extract_bvid_from_url(url: str) -> Optional[str]:
         return None
 
 
-def _walk_strings(obj) -> List[str]:
-    out: List[str] = []
-    try:
-        if isinstance(obj, dict):
-            for v in obj.values():
-                out.extend(_walk_strings(v))
-        elif isinstance(obj, list):
-            for it in obj:
-                out.extend(_walk_strings(it))
-        elif isinstance(obj, str):
-            out.append(obj)
-    except Exception:
-        pass
-    return out
+def _iter_strings(obj) -> Iterator[str]:
+    """迭代遍历 JSON 结构中的所有字符串（显式栈，避免递归与中间列表）"""
+    stack = [obj]
+    while stack:
+        x = stack.pop()
+        # 逆序入栈，保持与原文一致的先后顺序
+        if isinstance(x, dict):
+            stack.extend(reversed(list(x.values())))
+        elif isinstance(x, list):
+            stack.extend(reversed(x))
+        elif isinstance(x, str):
+            yield x
 
 
-def _extract_bili_urls_from_event(event: GroupMessageEvent) -> List[str]:
-    urls: List[str] = []
+async def _extract_bili_urls_from_event(event: GroupMessageEvent) -> List[str]:
+    # dict 充当有序集合：O(1) 去重并保留首次出现顺序
+    urls: Dict[str, None] = {}
     try:
         # 遍历消息段
         for seg in event.message:
             # 1) 纯文本
             if seg.type == "text":
                 txt = seg.data.get("text", "")
-                for u in _find_urls_in_text(txt):
-                    if u not in urls:
-                        urls.append(u)
+                _find_urls_in_text_into(txt, urls)
 
             # 2) JSON 卡片
             elif seg.type == "json":
                 raw = seg.data.get("data") or seg.data.get("content") or ""
-                for u in _find_urls_in_text(raw):
-                    if u not in urls:
-                        urls.append(u)
+                # 卡片原文不含 B 站标记时，解析和遍历也不可能找到链接
+                if not _has_bili_marker(raw):
+                    continue
+                _find_urls_in_text_into(raw, urls)
+                # 明显不是 JSON 或体积过大的载荷不再解析（原文已按正则扫描过）
+                raw_s = raw.lstrip()
+                if not raw_s or raw_s[0] not in "{[" or len(raw_s) > MAX_CARD_JSON_LEN:
+                    continue
                 try:
-                    obj = json.loads(raw)
-                    for s in _walk_strings(obj):
-                        for u in _find_urls_in_text(s):
-                            if u not in urls:
-                                urls.append(u)
+                    obj = _json_loads(raw_s)
+                    for s in _iter_strings(obj):
+                        _find_urls_in_text_into(s, urls)
                 except Exception:
                     pass
 
             # 3) XML 卡片
             elif seg.type == "xml":
                 raw = seg.data.get("data") or seg.data.get("content") or ""
-                for u in _find_urls_in_text(raw):
-                    if u not in urls:
-                        urls.append(u)
+                _find_urls_in_text_into(raw, urls)
 
             # 4) 分享卡片
             elif seg.type == "share":
                 u = seg.data.get("url") or ""
-                for u2 in _find_urls_in_text(u):
-                    if u2 not in urls:
-                        urls.append(u2)
+                _find_urls_in_text_into(u, urls)
 
-            # 5) 其他消息段
-            else:
-                s = str(seg)
-                for u in _find_urls_in_text(s):
-                    if u not in urls:
-                        urls.append(u)
+            # 5) 其他消息段：跳过不可能带链接的类型，其余直接扫描 data 中的字符串，
+            #    不经过 str(seg) 的 CQ 码序列化（转义还会把链接里的 & 改成 &amp;）
+            elif seg.type not in _NO_URL_SEG_TYPES:
+                for v in seg.data.values():
+                    if isinstance(v, str):
+                        _find_urls_in_text_into(v, urls)
 
         try:
             full_text = event.get_plaintext()
         except Exception:
             full_text = ""
 
-        # 匹配 av123456（不匹配纯数字）
-        for m in re.findall(r"(?i)\bav(\d+)\b", full_text):
-            av_str = f"av{m}"
-            if av_str not in urls:
-                urls.append(av_str)
-
-        # 匹配 AV 链接（如 /video/av123456/）
-        for m in re.findall(
-            r"https?://[^\s\"'<>]*/video/av(\d+)",
-            full_text,
-            flags=re.IGNORECASE,
-        ):
-            av_url = f"https://www.bilibili.com/video/av{m}/"
-            if av_url not in urls:
-                urls.append(av_url)
+        # 不含 "av" 的文本两个正则都不可能命中，先用子串判断跳过
+        flt = full_text.lower() if full_text else ""
+        if "av" in flt:
+            # 匹配 av123456（不匹配纯数字）
+            for m in AV_BARE_RE.findall(full_text):
+                urls.setdefault(f"av{m}", None)
+
+            # 匹配 AV 链接（如 /video/av123456/）
+            if "/video/av" in flt:
+                for m in AV_URL_RE.findall(full_text):
+                    urls.setdefault(f"https://www.bilibili.com/video/av{m}/", None)
 
     except Exception as e:
         logger.debug(f"bili2mp4: 提取链接异常: {e}")
 
-    norm_seen: Set[str] = set()
-    result: List[str] = []
-    for u in urls:
-        norm = _normalize_bili_url(u)
-        if norm not in norm_seen:
-            norm_seen.add(norm)
-            result.append(norm)
-
-    return result
+    # 规范化可能需要请求展开短链，各链接并发进行，去重后保留原有顺序
+    normalized = await asyncio.gather(*(_normalize_bili_url(u) for u in urls))
+    return list(dict.fromkeys(normalized))
 
 
+@functools.lru_cache(maxsize=4096)
 def _extract_aid_from_url(url: str) -> Optional[int]:
     """从 B 站链接中提取 AV 号"""
     try:
         parsed = urlparse(url)
         # /video/av123456
-        m = re.search(r"/video/av(\d+)", parsed.path, flags=re.IGNORECASE)
+        m = VIDEO_AV_PATH_RE.search(parsed.path)
         if m:
             return int(m.group(1))
 
@@ -346,7 +650,7 @@ def _extract_aid_from_url(url: str) -> Optional[int]:
         for key in ("aid", "avid"):
             vals = qs.get(key)
             if vals:
-                num_m = re.search(r"(\d+)", vals[0])
+                num_m = DIGITS_RE.search(vals[0])
                 if num_m:
                     return int(num_m.group(1))
 
@@ -355,38 +659,36 @@ def _extract_aid_from_url(url: str) -> Optional[int]:
         return None
 
 
+@functools.lru_cache(maxsize=4096)
 def _bili_av_to_bv(aid: int) -> Optional[str]:
     """将 AV 号转换为 BV 号"""
     try:
         if not (_BILI_MIN_AVID <= aid < _BILI_MAX_AVID):
             return None
 
-        r = _BILI_MAX_AVID | aid
-        r ^= _BILI_XOR_CODE
-
-        ans = ["B", "V", "1"] + ["0"] * 9
-        bvidx = len(ans) - 1
-
-        while r:
-            idx = r % _BILI_BASE
-            ans[bvidx] = _BILI_TABLE[idx]
-            r //= _BILI_BASE
-            bvidx -= 1
-
-        # swap(ans, 3, 9); swap(ans, 4, 7)
-        ans[3], ans[9] = ans[9], ans[3]
-        ans[4], ans[7] = ans[7], ans[4]
-
-        return "".join(ans)
+        r = (_BILI_MAX_AVID | aid) ^ _BILI_XOR_CODE
+        t = _BILI_TABLE_B
+        ans = bytearray(b"BV1000000000")
+        # 9 位 58 进制数从低位起依次写入的下标（已合并 swap(3, 9)、swap(4, 7)）
+        r, i = divmod(r, _BILI_BASE); ans[11] = t[i]
+        r, i = divmod(r, _BILI_BASE); ans[10] = t[i]
+        r, i = divmod(r, _BILI_BASE); ans[3] = t[i]
+        r, i = divmod(r, _BILI_BASE); ans[8] = t[i]
+        r, i = divmod(r, _BILI_BASE); ans[4] = t[i]
+        r, i = divmod(r, _BILI_BASE); ans[6] = t[i]
+        r, i = divmod(r, _BILI_BASE); ans[5] = t[i]
+        r, i = divmod(r, _BILI_BASE); ans[7] = t[i]
+        ans[9] = t[r]
+        return ans.decode()
     except Exception:
         return None
 
 
-def _normalize_bili_url(raw: str) -> str:
+async def _normalize_bili_url(raw: str) -> str:
     u = (raw or "").strip()
 
     # 1) av123456 / AV123456 这种纯 AV 前缀形式
-    m = re.fullmatch(r"(?i)av(\d+)", u)
+    m = AV_ID_RE.fullmatch(u)
     if m:
         aid = int(m.group(1))
         bv = _bili_av_to_bv(aid)
@@ -399,7 +701,7 @@ def _normalize_bili_url(raw: str) -> str:
         return raw
 
     # 3) 先展开 b23.tv 短链
-    u2 = _expand_short_url(u)
+    u2 = await _expand_short_url(u)
 
     # 4) 如果是 AV 链接，转为 BV 链接
     aid = _extract_aid_from_url(u2)
@@ -431,25 +733,73 @@ def _build_browser_like_headers() -> dict:
     }
 
 
-def _expand_short_url(u: str, timeout: float = 8.0) -> str:
+def _get_http_session() -> aiohttp.ClientSession:
+    """获取共享的 aiohttp 会话，复用连接池"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        # 请求集中在少数几个 B 站域名，限制单主机连接数并延长 keep-alive 以复用连接
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=32,
+                limit_per_host=8,
+                ttl_dns_cache=300,
+                keepalive_timeout=60,
+            ),
+            # 与 yt-dlp 一致，遵循环境变量中的 HTTP(S)_PROXY / NO_PROXY
+            trust_env=True,
+        )
+    return _http_session
+
+
+async def _expand_short_url(u: str, timeout: float = 8.0) -> str:
     try:
         host = urlparse(u).hostname or ""
         if host.lower() not in {"b23.tv", "www.b23.tv"}:
             return u
+
+        # 短链指向固定不变，展开成功的结果按 LRU 缓存，重复分享不再发请求
+        cached = _short_url_cache.get(u)
+        if cached is not None:
+            _short_url_cache.move_to_end(u)
+            return cached
+
         hdrs = {
             "User-Agent": _build_browser_like_headers()["User-Agent"],
             "Referer": "https://www.bilibili.com/",
         }
+        session = _get_http_session()
+        client_timeout = aiohttp.ClientTimeout(total=timeout)
         try:
-            req = urllib.request.Request(u, headers=hdrs, method="HEAD")
-            with urllib.request.urlopen(req, timeout=timeout) as resp:
-                final = resp.geturl()
-                return final or u
+            # aiohttp 默认不因 4xx/5xx 抛异常；HEAD 被拒（如 405/412）时同样改用 GET 重试
+            async with session.head(
+                u,
+                headers=hdrs,
+                timeout=client_timeout,
+                allow_redirects=True,
+                raise_for_status=True,
+            ) as resp:
+                final = str(resp.url)
         except Exception:
-            req = urllib.request.Request(u, headers=hdrs, method="GET")
-            with urllib.request.urlopen(req, timeout=timeout) as resp:
-                final = resp.geturl()
-                return final or u
+            async with session.get(
+                u, headers=hdrs, timeout=client_timeout, allow_redirects=True
+            ) as resp:
+                if resp.status >= 400:
+                    # 风控（403/412）或失效短链：不缓存，下次分享时重新展开
+                    logger.debug(f"bili2mp4: 短链展开返回 HTTP {resp.status}，使用原链接（{u}）")
+                    return u
+                final = str(resp.url)
+        if not final:
+            return u
+
+        # 仍停留在 b23.tv 说明没有真正展开，不能当作成功结果缓存
+        final_host = (urlparse(final).hostname or "").lower()
+        if final_host in {"b23.tv", "www.b23.tv"}:
+            return final
+
+        _short_url_cache[u] = final
+        while len(_short_url_cache) > _SHORT_URL_CACHE_MAXSIZE:
+            _short_url_cache.popitem(last=False)
+        return final
     except Exception as e:
         logger.debug(f"bili2mp4: 短链展开失败，使用原链接（{u}）：{e}")
         return u
@@ -459,11 +809,13 @@ def _ensure_cookiefile(cookie_string: str) -> Optional[str]:
     """
     将 Cookie 字符串转为 Netscape 格式，供 yt-dlp 使用。
     """
+    global _last_cookie_state
     if COOKIE_FILE_PATH is None:
         return None
 
     cookie_string = (cookie_string or "").strip().strip(";")
     if not cookie_string:
+        _last_cookie_state = None
         if COOKIE_FILE_PATH.exists():
             try:
                 COOKIE_FILE_PATH.unlink()
@@ -471,6 +823,20 @@ def _ensure_cookiefile(cookie_string: str) -> Optional[str]:
                 pass
         return None
 
+    # Cookie 未变、文件仍是上次写入的样子且未过刷新期时直接复用，不必每次下载都重写
+    h = hashlib.blake2b(cookie_string.encode(), digest_size=16).digest()
+    last = _last_cookie_state
+    if last is not None and last[0] == h:
+        try:
+            st = COOKIE_FILE_PATH.stat()
+            if (
+                (st.st_mtime_ns, st.st_size) == last[1:]
+                and time.time() - st.st_mtime < _COOKIE_REFRESH_AGE
+            ):
+                return str(COOKIE_FILE_PATH)
+        except OSError:
+            pass
+
     pairs = []
     for part in cookie_string.split(";"):
         part = part.strip()
@@ -484,26 +850,55 @@ def _ensure_cookiefile(cookie_string: str) -> Optional[str]:
         return None
 
     expiry = int(time.time()) + 180 * 24 * 3600
-    lines = [
-        "# Netscape HTTP Cookie File",
-        "# Generated by nonebot_plugin_bili2mp4",
-        "",
-    ]
-
+    parts = [b"# Netscape HTTP Cookie File\n# Generated by nonebot_plugin_bili2mp4\n\n"]
     for k, v in pairs:
         # domain include_subdomains path secure expiry name value
-        lines.append(f".bilibili.com\tTRUE\t/\tFALSE\t{expiry}\t{k}\t{v}")
+        parts.append(
+            b".bilibili.com\tTRUE\t/\tFALSE\t%d\t%s\t%s\n" % (expiry, k.encode(), v.encode())
+        )
 
     try:
-        with COOKIE_FILE_PATH.open("w", encoding="utf-8") as f:
-            f.write("\n".join(lines) + "\n")
+        # 下载在多个线程中并发进行，先写临时文件再替换，避免读到半截内容
+        fd, tmp = tempfile.mkstemp(
+            dir=str(COOKIE_FILE_PATH.parent), prefix=COOKIE_FILE_PATH.name + ".", suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(b"".join(parts))
+            os.replace(tmp, COOKIE_FILE_PATH)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        st = COOKIE_FILE_PATH.stat()
+        _last_cookie_state = (h, st.st_mtime_ns, st.st_size)
         logger.info("bili2mp4: Cookie 已设置")
         return str(COOKIE_FILE_PATH)
     except Exception:
         return None
 
 
-def _check_video_file(path: str) -> bool:
+def _copy_cookiefile(cookiefile: str) -> Optional[str]:
+    """
+    复制一份 cookie 文件供单次下载使用。
+    yt-dlp 结束时会把响应里的 Set-Cookie（如被风控清空的 SESSDATA）写回 cookiefile，
+    不能让它改掉管理员设置的 Cookie。
+    """
+    try:
+        fd, tmp = tempfile.mkstemp(
+            dir=str(Path(cookiefile).parent), prefix="ydl_cookies.", suffix=".txt"
+        )
+        os.close(fd)
+        shutil.copyfile(cookiefile, tmp)
+        return tmp
+    except Exception as e:
+        logger.warning(f"bili2mp4: 复制 cookie 文件失败，改用 Cookie header: {e}")
+        return None
+
+
+async def _check_video_file(path: str) -> bool:
     """检查视频分辨率（大小限制在 _download_with_ytdlp 中处理）"""
     try:
         path_obj = Path(path)
@@ -513,10 +908,9 @@ def _check_video_file(path: str) -> bool:
             return False
 
         # 检查视频分辨率
-        ffprobe_exe = "ffprobe.exe" if os.name == "nt" else "ffprobe"
-        cmd = [ffprobe_exe]
+        cmd = [FFPROBE_EXE]
         if FFMPEG_DIR:
-            cmd[0] = str(Path(FFMPEG_DIR) / ffprobe_exe)
+            cmd[0] = str(Path(FFMPEG_DIR) / FFPROBE_EXE)
 
         cmd.extend(
             [
@@ -532,10 +926,10 @@ def _check_video_file(path: str) -> bool:
             ]
         )
 
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(
+            _spawn_pool,
+            functools.partial(subprocess.run, cmd, capture_output=True, text=True),
         )
         if result.returncode == 0:
             try:
@@ -552,30 +946,71 @@ def _check_video_file(path: str) -> bool:
         return False
 
 
-def _get_bili_duration_seconds(url: str) -> Optional[int]:
+def _view_cache_get(bvid: str) -> Optional[dict]:
+    item = _view_cache.get(bvid)
+    if item is None:
+        return None
+    expires, info = item
+    if expires < time.monotonic():
+        _view_cache.pop(bvid, None)
+        return None
+    _view_cache.move_to_end(bvid)
+    return info
+
+
+def _view_cache_put(bvid: str, info: dict) -> None:
+    _view_cache[bvid] = (time.monotonic() + _VIEW_CACHE_TTL, info)
+    _view_cache.move_to_end(bvid)
+    while len(_view_cache) > _VIEW_CACHE_MAXSIZE:
+        _view_cache.popitem(last=False)
+
+
+async def _get_bili_view_info(bvid: str) -> Optional[dict]:
     """
-    通过 B 站开放接口获取视频时长（秒）
+    获取 view 接口返回的 data 字段，按 bvid 做 TTL 缓存；
+    同一 bvid 的并发请求只会真正请求一次
     """
-    try:
-        norm = _normalize_bili_url(url)
-        bvid = _extract_bvid_from_url(norm)
-        if not bvid:
-            return None
+    info = _view_cache_get(bvid)
+    if info is not None:
+        return info
+
+    async with _hold_url_lock(f"view:{bvid}"):
+        info = _view_cache_get(bvid)
+        if info is not None:
+            return info
 
         api_url = f"https://api.bilibili.com/x/web-interface/view?bvid={bvid}"
-        req = urllib.request.Request(
+        session = _get_http_session()
+        async with session.get(
             api_url,
             headers=_build_browser_like_headers(),
-            method="GET",
-        )
-        with urllib.request.urlopen(req, timeout=8.0) as resp:
-            raw = resp.read().decode("utf-8", "ignore")
-        data = json.loads(raw)
+            timeout=aiohttp.ClientTimeout(total=8.0),
+        ) as resp:
+            # json / orjson 均可直接解析 UTF-8 字节，无需先解码为 str
+            data = _json_loads(await resp.read())
 
         if data.get("code") != 0:
             return None
 
-        d = data.get("data") or {}
+        info = data.get("data") or {}
+        _view_cache_put(bvid, info)
+        return info
+
+
+async def _get_bili_duration_seconds(url: str) -> Optional[int]:
+    """
+    通过 B 站开放接口获取视频时长（秒）
+    """
+    try:
+        norm = await _normalize_bili_url(url)
+        bvid = _extract_bvid_from_url(norm)
+        if not bvid:
+            return None
+
+        d = await _get_bili_view_info(bvid)
+        if d is None:
+            return None
+
         dur = d.get("duration")
         if isinstance(dur, int):
             return dur
@@ -587,30 +1022,37 @@ def _get_bili_duration_seconds(url: str) -> Optional[int]:
 
 async def _send_video_with_timeout(
     bot: Bot, group_id: int, path: str, title: str
-) -> None:
+) -> bool:
+    """发送视频并删除本地文件，返回是否发送成功"""
     path_obj = Path(path)
 
     try:
         if not path_obj.exists():
             logger.warning(f"bili2mp4: 待发送文件不存在: {path}")
-            return
+            return False
 
         # 如果存在映射，使用映射后的虚拟路径发送
         send_path = str(path_obj)
-        for virt, real in path_mappings.items():
-            try:
-                real_p = str(Path(real).resolve())
-                p_resolved = str(path_obj.resolve())
-                if p_resolved.startswith(real_p):
-                    # 构造虚拟路径：映射路径 + 相对路径
-                    rel = p_resolved[len(real_p):].replace("\\", "/")
-                    if not rel.startswith("/"):
-                        rel = "/" + rel
-                    send_path = virt.rstrip("/") + rel
-                    logger.debug(f"bili2mp4: 使用映射发送路径 {send_path} (real={p_resolved})")
-                    break
-            except Exception:
-                continue
+        try:
+            p_resolved = str(path_obj.resolve()) if _mapping_index else ""
+        except Exception:
+            p_resolved = ""
+        if p_resolved:
+            for real_p, virt in _mapping_index:
+                # 按路径分量比较，避免 /a/bc 被误当作 /a/b 下的文件
+                try:
+                    if os.path.commonpath([p_resolved, real_p]) != real_p:
+                        continue
+                except ValueError:
+                    # 不同盘符或绝对/相对路径混用
+                    continue
+                # 构造虚拟路径：映射路径 + 相对路径
+                rel = p_resolved[len(real_p):].replace("\\", "/")
+                if not rel.startswith("/"):
+                    rel = "/" + rel
+                send_path = virt.rstrip("/") + rel
+                logger.debug(f"bili2mp4: 使用映射发送路径 {send_path} (real={p_resolved})")
+                break
 
         # 通过文件路径发送视频
         await bot.send_group_msg(
@@ -619,9 +1061,11 @@ async def _send_video_with_timeout(
             + Message(f"\n{title or 'B站视频'}"),
         )
         logger.info(f"bili2mp4: 发送视频到群 {group_id}: {title or 'B站视频'}")
+        return True
 
     except Exception as e:
         logger.warning(f"bili2mp4: 发送视频失败: {e}")
+        return False
     finally:
         try:
             if path_obj.exists():
@@ -663,9 +1107,72 @@ def _locate_final_file(ydl, info) -> Optional[str]:
     return None
 
 
+def _info_dimensions(info: dict) -> Tuple[Optional[int], Optional[int]]:
+    """从 yt-dlp 的信息字典中取视频宽高（合并格式时取视频流的宽高）"""
+    width, height = info.get("width"), info.get("height")
+    if width is None or height is None:
+        for it in info.get("requested_formats") or []:
+            if it.get("vcodec") and it.get("vcodec") != "none":
+                width, height = it.get("width"), it.get("height")
+                break
+    try:
+        return (
+            int(width) if width is not None else None,
+            int(height) if height is not None else None,
+        )
+    except (TypeError, ValueError):
+        return None, None
+
+
+def _build_format_selector(height_limit: int, size_limit_mb: float, relaxed: bool = True) -> str:
+    """
+    构造 yt-dlp 格式选择器：先按高度+大小筛选视频流；
+    relaxed 为真时，选不到符合大小的流再放宽大小限制。
+    """
+    height_filter = f"[height<=?{height_limit}]" if height_limit else ""
+    chain = []
+    if size_limit_mb:
+        # B站的 DASH 流有的只给 filesize、有的只给 filesize_approx，两者都要约束
+        size = f"{size_limit_mb:.2f}MiB"
+        chain.append(f"bv{height_filter}[filesize<=?{size}][filesize_approx<=?{size}]+ba")
+    if relaxed or not chain:
+        chain.append(f"bv{height_filter}+ba")
+    return "/".join(chain)
+
+
+def _has_audio_stream(final_path: str, info: dict) -> bool:
+    """用 ffprobe 检查成品是否含音轨；ffprobe 不可用时退回 yt-dlp 的格式信息"""
+    try:
+        cmd = [FFPROBE_EXE]
+        if FFMPEG_DIR:
+            cmd[0] = str(Path(FFMPEG_DIR) / FFPROBE_EXE)
+        cmd.extend(["-v", "error", "-select_streams", "a", "-show_entries", "stream=index", "-of", "csv=p=0", final_path])
+        res = subprocess.run(cmd, capture_output=True, text=True)
+        return bool(res.stdout.strip())
+    except Exception:
+        pass
+    try:
+        if info.get("acodec") and info.get("acodec") != "none":
+            return True
+        # 检查 requested_formats 中是否有 audio part
+        reqs = info.get("requested_formats") or info.get("requested_downloads") or []
+        return any(it.get("acodec") and it.get("acodec") != "none" for it in reqs)
+    except Exception:
+        return True  # 保守假定有音频
+
+
+def _copy_ie_result(ie_result: dict) -> Optional[dict]:
+    """复制提取结果；含无法深拷贝的对象（如惰性列表、提取器引用）时返回 None"""
+    try:
+        return copy.deepcopy(ie_result)
+    except Exception:
+        return None
+
+
 def _download_with_ytdlp(
     url: str, cookie: str, out_dir, height_limit: int, size_limit_mb: int
-) -> Tuple[str, str]:
+) -> Tuple[str, str, Optional[int], Optional[int]]:
+    """下载视频，返回 (文件路径, 标题, 宽, 高)；宽高取自 yt-dlp 信息，未知时为 None"""
     try:
         from yt_dlp import YoutubeDL  # type: ignore
         from yt_dlp.utils import DownloadError  # type: ignore
@@ -675,396 +1182,434 @@ def _download_with_ytdlp(
     out_dir = Path(out_dir)
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    final_url = _expand_short_url(url)
+    # url 已在 _download_and_send 中规范化（短链已展开）
+    final_url = url
     cookiefile = _ensure_cookiefile(cookie)
-
-    headers = _build_browser_like_headers()
-    base_opts = {
-        "outtmpl": str(out_dir / "%(title).80s [%(id)s].%(ext)s"),
-        "noplaylist": True,
-        "merge_output_format": "mp4",
-        "quiet": False,
-        "no_warnings": False,
-        "http_headers": headers,
-        "extractor_args": {"bili": {"player_client": ["android", "web"], "lang": ["zh-CN"]}},
-    }
-    if FFMPEG_DIR:
-        base_opts["ffmpeg_location"] = FFMPEG_DIR
     if cookiefile:
-        base_opts["cookiefile"] = cookiefile
-        logger.info(f"bili2mp4: 使用 cookiefile: {cookiefile}")
-    elif cookie:
-        headers["Cookie"] = cookie
-        logger.info("bili2mp4: 使用 Cookie header")
-
-    def _estimate_size_bytes(fmt: dict) -> Optional[int]:
-        v = fmt.get("filesize_approx") or fmt.get("filesize")
-        try:
-            return int(v) if v is not None else None
-        except Exception:
-            return None
+        cookiefile = _copy_cookiefile(cookiefile)
 
     try:
-        with YoutubeDL(base_opts) as ydl:
-            info = ydl.extract_info(final_url, download=False)
-            title = info.get("title") or "B站视频"
-            formats = info.get("formats", []) or []
-    except Exception as e:
-        raise RuntimeError(f"获取视频格式信息失败: {e}")
-
-    video_only = [f for f in formats if f.get("vcodec") and f.get("vcodec") != "none" and (not f.get("acodec") or f.get("acodec") == "none")]
-    audio_only = [f for f in formats if f.get("acodec") and f.get("acodec") != "none" and (not f.get("vcodec") or f.get("vcodec") == "none")]
-
-    if not video_only or not audio_only:
-        raise RuntimeError("未找到可用的 video-only 或 audio-only 格式")
-
-    def _video_key(f):
-        return ((f.get("height") or 0), (f.get("tbr") or 0))
-
-    video_only.sort(key=_video_key, reverse=True)
-    audio_only.sort(key=lambda f: (f.get("abr") or 0, f.get("tbr") or 0), reverse=True)
-
-    candidates: List[Tuple[str, dict, dict, Optional[int]]] = []
-    for vfmt in video_only:
-        vh = vfmt.get("height") or 0
-        if height_limit and vh and vh > height_limit:
-            logger.debug(f"bili2mp4: 跳过 video-only 格式 {vfmt.get('format_id')}，高度 {vh} 超过限制 {height_limit}")
-            continue
-
-        for afmt in audio_only:
-            # estimate combined size if possible
-            v_size = _estimate_size_bytes(vfmt)
-            a_size = _estimate_size_bytes(afmt)
-            est_sum = None
-            if v_size is not None or a_size is not None:
-                est_sum = (v_size or 0) + (a_size or 0)
-
-            if size_limit_mb and est_sum is not None:
-                if est_sum / (1024 * 1024) > size_limit_mb:
-                    logger.info(
-                        f"bili2mp4: 预检跳过组合 {vfmt.get('format_id')}+{afmt.get('format_id')}，估算大小 {est_sum/(1024*1024):.2f}MB 超过限制 {size_limit_mb}MB"
-                    )
-                    # try next audio (smaller abr) for same video
-                    continue
-
-            fmt_expr = f"{vfmt.get('format_id')}+{afmt.get('format_id')}"
-            candidates.append((fmt_expr, vfmt, afmt, est_sum))
-            break
-
-    if not candidates:
-        logger.info("bili2mp4: 预检未找到合适组合，放宽大小限制并尝试最高质量组合")
-        # take top video and top audio
-        vfmt = video_only[0]
-        afmt = audio_only[0]
-        fmt_expr = f"{vfmt.get('format_id')}+{afmt.get('format_id')}"
-        candidates.append((fmt_expr, vfmt, afmt, None))
-
-    last_err: Optional[Exception] = None
-
-    for fmt_expr, vfmt, afmt, est_sum in candidates:
-        logger.info(f"bili2mp4: 尝试下载组合 {fmt_expr} 估算大小={'未知' if est_sum is None else f'{est_sum/(1024*1024):.2f}MB'}")
-        opts = dict(base_opts)
-        opts["format"] = fmt_expr
-
-        try:
-            with YoutubeDL(opts) as ydl:
-                info2 = ydl.extract_info(final_url, download=True)
-                title2 = info2.get("title") or title
-                final_path = _locate_final_file(ydl, info2)
-                if not final_path or not Path(final_path).exists():
-                    logger.debug(f"bili2mp4: 下载后未找到文件，组合 {fmt_expr}")
-                    last_err = RuntimeError("下载后未找到文件")
-                    continue
-
-                if size_limit_mb:
-                    try:
-                        size_mb = Path(final_path).stat().st_size / (1024 * 1024)
-                        if size_mb > size_limit_mb:
-                            logger.info(f"bili2mp4: 下载后文件 {final_path} 大小 {size_mb:.2f}MB 超过限制 {size_limit_mb}MB，删除并尝试下一个候选")
-                            try:
-                                Path(final_path).unlink(missing_ok=True)
-                            except Exception as e:
-                                logger.debug(f"bili2mp4: 删除超限文件失败 {final_path}: {e}")
-                            last_err = RuntimeError("文件超过大小限制")
-                            continue
-                    except Exception:
-                        logger.debug(f"bili2mp4: 无法读取已下载文件大小以确认限制: {final_path}")
+        headers = _build_browser_like_headers()
+        base_opts = {
+            "outtmpl": str(out_dir / "%(title).80s [%(id)s].%(ext)s"),
+            "noplaylist": True,
+            "merge_output_format": "mp4",
+            "quiet": False,
+            "no_warnings": False,
+            "http_headers": headers,
+            "extractor_args": {"bili": {"player_client": ["android", "web"], "lang": ["zh-CN"]}},
+        }
+        if FFMPEG_DIR:
+            base_opts["ffmpeg_location"] = FFMPEG_DIR
+        if ARIA2C_PATH:
+            # 单连接下载会被 CDN 限速，交给 aria2c 以多个 Range 请求并发下载
+            base_opts["external_downloader"] = {"http": ARIA2C_PATH}
+            base_opts["external_downloader_args"] = {
+                "aria2c": [
+                    "-x", str(ARIA2C_SPLIT),
+                    "-s", str(ARIA2C_SPLIT),
+                    "-k", "1M",
+                ]
+            }
+        elif FFMPEG_DIR and FFMPEG_DOWNLOAD:
+            # 由 ffmpeg 直接拉取音视频两路流并边下边封装成 MP4，
+            # 省去先落盘两个分段文件再读回合并的一整轮磁盘读写；
+            # 但 ffmpeg 拉流不支持重试和断点续传，因此仅在配置开启时使用
+            base_opts["external_downloader"] = {"http": "ffmpeg"}
+        else:
+            # 仅 yt-dlp 内置下载器使用该参数，外部下载器下设置无效
+            base_opts["buffersize"] = YTDLP_BUFFER_SIZE
+        if cookiefile:
+            base_opts["cookiefile"] = cookiefile
+            logger.info(f"bili2mp4: 使用 cookiefile: {cookiefile}")
+        elif cookie:
+            headers["Cookie"] = cookie
+            logger.info("bili2mp4: 使用 Cookie header")
+
+        # 同一高度下优先 H.264：合并时直接 -c copy 封装进 MP4，各端都能播放
+        base_opts["format_sort"] = ["res", "vcodec:avc", "br"]
+
+        budget_mb: float = size_limit_mb
+        last_err: Optional[Exception] = None
+
+        # 提取器结果（含签名请求的产物）：重试时交给新的 YoutubeDL 实例复用，不再重复提取
+        ie_result: Optional[dict] = None
+
+        for attempt in range(2):
+            # 重试时不再放宽大小限制：放宽后选中的还是上次那条超限的流，
+            # 只会把同一个文件再完整下载一遍；没有更小的流时直接报格式不可用
+            fmt_expr = _build_format_selector(height_limit, budget_mb, relaxed=attempt == 0)
+            logger.info(f"bili2mp4: 使用格式选择器 {fmt_expr}")
+            opts = dict(base_opts)
+            opts["format"] = fmt_expr
 
+            try:
+                with YoutubeDL(opts) as ydl:
+                    if ie_result is None:
+                        ie_result = ydl.extract_info(final_url, download=False, process=False)
+                    # process_ie_result 会就地修改信息字典，传入副本以便重试时复用；
+                    # 复制失败时直接处理原结果，重试时再重新提取
+                    src = _copy_ie_result(ie_result)
+                    if src is None:
+                        src, ie_result = ie_result, None
+                    info = ydl.process_ie_result(src, download=True)
+                    title = info.get("title") or "B站视频"
+                    final_path = _locate_final_file(ydl, info)
+            except DownloadError as e:
+                # 重试失败时保留首次的超限原因，比"格式不可用"更能说明问题
+                last_err = last_err or e
+                logger.warning(f"bili2mp4: 格式 {fmt_expr} 下载失败: {e}")
+                break
+            except Exception as e:
+                last_err = last_err or e
+                logger.warning(f"bili2mp4: 格式 {fmt_expr} 异常: {e}")
+                break
+
+            if not final_path or not Path(final_path).exists():
+                last_err = RuntimeError("下载后未找到文件")
+                break
+
+            if size_limit_mb:
                 try:
-                    ffprobe_exe = "ffprobe.exe" if os.name == "nt" else "ffprobe"
-                    cmd = [ffprobe_exe]
-                    if FFMPEG_DIR:
-                        cmd[0] = str(Path(FFMPEG_DIR) / ffprobe_exe)
-                    cmd.extend(["-v", "error", "-select_streams", "a", "-show_entries", "stream=index", "-of", "csv=p=0", final_path])
-                    res = subprocess.run(cmd, capture_output=True, text=True)
-                    has_audio = bool(res.stdout.strip())
+                    size_mb = Path(final_path).stat().st_size / (1024 * 1024)
                 except Exception:
-                    has_audio = False
-                    try:
-                        if info2.get("acodec") and info2.get("acodec") != "none":
-                            has_audio = True
-                        else:
-                            # 检查 requested_formats 中是否有 audio part
-                            reqs = info2.get("requested_formats") or info2.get("requested_downloads") or []
-                            for it in reqs:
-                                if it.get("acodec") and it.get("acodec") != "none":
-                                    has_audio = True
-                                    break
-                    except Exception:
-                        has_audio = True  # 保守假定有音频
-
-                if not has_audio:
-                    logger.warning(f"bili2mp4: 已下载文件 {final_path} 未检测到音频流，删除并尝试下一个候选")
+                    size_mb = 0.0
+                    logger.debug(f"bili2mp4: 无法读取已下载文件大小以确认限制: {final_path}")
+                if size_mb > size_limit_mb:
+                    # 选择器只按视频流估算大小，音频和封装开销可能让成品略微超限；
+                    # 按超出比例收紧视频预算再试一次
+                    logger.info(f"bili2mp4: 下载后文件 {final_path} 大小 {size_mb:.2f}MB 超过限制 {size_limit_mb}MB，删除并收紧预算重试")
                     try:
                         Path(final_path).unlink(missing_ok=True)
                     except Exception as e:
-                        logger.debug(f"bili2mp4: 删除无音频文件失败 {final_path}: {e}")
-                    last_err = RuntimeError("下载文件无音频")
+                        logger.debug(f"bili2mp4: 删除超限文件失败 {final_path}: {e}")
+                    last_err = RuntimeError("文件超过大小限制")
+                    budget_mb = budget_mb * size_limit_mb / size_mb * 0.95
                     continue
 
-                logger.info(f"bili2mp4: 下载并通过检查: {final_path}")
-                return final_path, title2
+            if not _has_audio_stream(final_path, info):
+                logger.warning(f"bili2mp4: 已下载文件 {final_path} 未检测到音频流，删除")
+                try:
+                    Path(final_path).unlink(missing_ok=True)
+                except Exception as e:
+                    logger.debug(f"bili2mp4: 删除无音频文件失败 {final_path}: {e}")
+                last_err = RuntimeError("下载文件无音频")
+                break
+
+            logger.info(f"bili2mp4: 下载并通过检查: {final_path}")
+            width, height = _info_dimensions(info)
+            return final_path, title, width, height
+
+        if last_err:
+            raise RuntimeError(str(last_err))
+        raise RuntimeError("无法下载该视频（没有满足条件的格式或下载失败）")
+    finally:
+        if cookiefile:
+            try:
+                os.unlink(cookiefile)
+            except OSError:
+                pass
+
+
+def _get_job_semaphore() -> asyncio.Semaphore:
+    global _job_sem
+    if _job_sem is None:
+        _job_sem = asyncio.Semaphore(MAX_CONCURRENT_JOBS)
+    return _job_sem
+
+
+@asynccontextmanager
+async def _hold_url_lock(key: str):
+    """按键加锁：同一键（视频 URL、bvid 等）串行处理，不同键互不影响"""
+    lock = _url_locks.get(key)
+    if lock is None:
+        lock = _url_locks[key] = asyncio.Lock()
+    _url_lock_users[key] = _url_lock_users.get(key, 0) + 1
+    try:
+        async with lock:
+            yield
+    finally:
+        users = _url_lock_users[key] - 1
+        if users:
+            _url_lock_users[key] = users
+        else:
+            _url_lock_users.pop(key, None)
+            _url_locks.pop(key, None)
 
-        except DownloadError as e:
-            last_err = e
-            logger.warning(f"bili2mp4: 组合 {fmt_expr} 下载失败: {e}")
-            continue
-        except Exception as e:
-            last_err = e
-            logger.warning(f"bili2mp4: 组合 {fmt_expr} 异常: {e}")
-            continue
 
-    if last_err:
-        raise RuntimeError(str(last_err))
-    raise RuntimeError("无法下载该视频（所有候选组合均不满足条件或下载失败）")
+def _mark_recent_url(group_id: int, url: str) -> bool:
+    """登记一次受理；该群在 TTL 内已受理过同一视频时返回 False"""
+    key = (group_id, url)
+    now = time.monotonic()
+    expires = _recent_urls.get(key)
+    if expires is not None and expires >= now:
+        return False
+    # 条目按登记顺序排列，过期时间也单调递增，从头部清理即可
+    while _recent_urls:
+        oldest_expires = next(iter(_recent_urls.values()))
+        if oldest_expires >= now and len(_recent_urls) < _RECENT_URL_MAXSIZE:
+            break
+        _recent_urls.popitem(last=False)
+    _recent_urls.pop(key, None)
+    _recent_urls[key] = now + _RECENT_URL_TTL
+    return True
 
 
 async def _download_and_send(bot: Bot, group_id: int, url: str) -> None:
-    norm_url = _normalize_bili_url(url)
+    norm_url = await _normalize_bili_url(url)
 
-    key = f"{group_id}:{norm_url}"
-    if key in _processing:
-        logger.info(f"bili2mp4: 群 {group_id} 正在处理同一视频 {norm_url}，跳过重复任务")
+    # 检查与登记之间没有 await，单线程事件循环内无需额外加锁
+    if not _mark_recent_url(group_id, norm_url):
+        logger.info(
+            f"bili2mp4: 群 {group_id} 在 {_RECENT_URL_TTL}s 内已处理过 {norm_url}（处理中或已发送），按去重策略跳过"
+        )
         return
 
-    _processing.add(key)
+    # 同一视频的下载会写入同一个文件，必须串行，后到的任务排队等待
+    lock = _url_locks.get(norm_url)
+    if lock is not None and lock.locked():
+        logger.info(f"bili2mp4: 视频 {norm_url} 正在处理，群 {group_id} 的任务排队等待")
+
+    sent = False
     try:
-        # 时长限制检查
-        if max_duration_sec:
-            dur = _get_bili_duration_seconds(norm_url)
-            if dur is not None:
-                if dur > max_duration_sec:
-                    logger.info(
-                        f"bili2mp4: 视频时长 {dur}s 超出限制 {max_duration_sec}s，跳过下载 {norm_url}"
-                    )
-                    return
-                else:
-                    logger.info(
-                        f"bili2mp4: 视频时长 {dur}s 在限制 {max_duration_sec}s 内，继续下载"
-                    )
+        async with _group_sems[group_id], _hold_url_lock(norm_url):
+            sent = await _process_video(bot, group_id, norm_url)
+    finally:
+        # 未成功发送（下载失败、超限、无音频等）时撤销登记，允许群友重新分享后重试
+        if not sent:
+            _recent_urls.pop((group_id, norm_url), None)
+
+
+async def _process_video(bot: Bot, group_id: int, norm_url: str) -> bool:
+    """下载并发送视频，返回是否已成功发送到群"""
+    # 时长限制检查
+    if max_duration_sec:
+        dur = await _get_bili_duration_seconds(norm_url)
+        if dur is not None:
+            if dur > max_duration_sec:
+                logger.info(
+                    f"bili2mp4: 视频时长 {dur}s 超出限制 {max_duration_sec}s，跳过下载 {norm_url}"
+                )
+                return False
+            else:
+                logger.info(
+                    f"bili2mp4: 视频时长 {dur}s 在限制 {max_duration_sec}s 内，继续下载"
+                )
 
-        # 下载视频
-        try:
-            if DOWNLOAD_DIR is None:
-                raise RuntimeError("DOWNLOAD_DIR 未初始化")
-            final_path, title = _download_with_ytdlp(
+    # 下载视频
+    try:
+        if DOWNLOAD_DIR is None:
+            raise RuntimeError("DOWNLOAD_DIR 未初始化")
+        # yt-dlp 为同步阻塞调用，放到线程中执行以免阻塞事件循环
+        async with _get_job_semaphore():
+            final_path, title, width, height = await _run_in_thread(
+                _download_with_ytdlp,
                 norm_url,
                 bilibili_cookie,
                 DOWNLOAD_DIR,
                 max_height,
                 max_filesize_mb,
             )
-        except Exception as e:
-            logger.warning(f"bili2mp4: 下载环境异常: {e}")
-            return
+    except Exception as e:
+        logger.warning(f"bili2mp4: 下载环境异常: {e}")
+        return False
 
-        # 分辨率检查
-        if not _check_video_file(final_path):
-            logger.warning(f"bili2mp4: 文件检查未通过，跳过发送: {final_path}")
-            return
+    # 分辨率检查：yt-dlp 已给出宽高时直接比较，仅在缺失时才用 ffprobe 探测
+    if width is not None and height is not None:
+        if max_height and height > max_height:
+            logger.warning(
+                f"bili2mp4: 视频高度 {height} 超过限制 {max_height}，跳过发送: {final_path}"
+            )
+            Path(final_path).unlink(missing_ok=True)
+            return False
+    elif not await _check_video_file(final_path):
+        logger.warning(f"bili2mp4: 文件检查未通过，跳过发送: {final_path}")
+        return False
 
-        # 发送视频
-        await _send_video_with_timeout(bot, group_id, final_path, title)
+    # 发送视频
+    return await _send_video_with_timeout(bot, group_id, final_path, title)
 
-    finally:
-        _processing.discard(key)
 
+# =========================
+# 私聊命令处理
+# =========================
 
-async def _handle_group_command(
-    bot: Bot, event: PrivateMessageEvent, text: str
-) -> bool:
-    """处理群相关命令"""
-    global enabled_groups
 
-    # 开启群
-    m = CMD_ENABLE_RE.fullmatch(text)
-    if m:
-        gid = int(m.group(1))
-        if gid in enabled_groups:
-            await bot.send(event, Message(f"ℹ️ 群 {gid} 已开启转换"))
-        else:
-            enabled_groups.add(gid)
-            _save_state()
-            await bot.send(event, Message(f"✅ 已开启群 {gid} 的B站视频转换"))
-        return True
+async def _cmd_enable(bot: Bot, event: PrivateMessageEvent, m: re.Match) -> None:
+    gid = int(m.group("enable_gid"))
+    if gid in enabled_groups:
+        await bot.send(event, Message(f"ℹ️ 群 {gid} 已开启转换"))
+    else:
+        enabled_groups.add(gid)
+        _save_state()
+        await bot.send(event, Message(f"✅ 已开启群 {gid} 的B站视频转换"))
 
-    # 关闭群
-    m = CMD_DISABLE_RE.fullmatch(text)
-    if m:
-        gid = int(m.group(1))
-        if gid in enabled_groups:
-            enabled_groups.discard(gid)
-            _save_state()
-            await bot.send(event, Message(f"🛑 已停止群 {gid} 的B站视频转换"))
-        else:
-            await bot.send(event, Message(f"ℹ️ 群 {gid} 未开启转换"))
-        return True
 
-    # 查看列表
-    if text in CMD_LIST:
-        if enabled_groups:
-            sorted_g = sorted(list(enabled_groups))
-            await bot.send(
-                event, Message("当前已开启转换的群：" + ", ".join(map(str, sorted_g)))
-            )
-        else:
-            await bot.send(event, Message("暂无开启转换的群"))
-        return True
+async def _cmd_disable(bot: Bot, event: PrivateMessageEvent, m: re.Match) -> None:
+    gid = int(m.group("disable_gid"))
+    if gid in enabled_groups:
+        enabled_groups.discard(gid)
+        _save_state()
+        await bot.send(event, Message(f"🛑 已停止群 {gid} 的B站视频转换"))
+    else:
+        await bot.send(event, Message(f"ℹ️ 群 {gid} 未开启转换"))
 
-    return False
 
+async def _cmd_list(bot: Bot, event: PrivateMessageEvent, m: re.Match) -> None:
+    if enabled_groups:
+        sorted_g = sorted(list(enabled_groups))
+        await bot.send(
+            event, Message("当前已开启转换的群：" + ", ".join(map(str, sorted_g)))
+        )
+    else:
+        await bot.send(event, Message("暂无开启转换的群"))
 
-async def _handle_config_command(
-    bot: Bot, event: PrivateMessageEvent, text: str
-) -> bool:
-    """处理配置相关命令"""
-    global bilibili_cookie, max_height, max_filesize_mb, max_duration_sec, path_mappings
 
-    # 设置Cookie
-    m = CMD_SET_COOKIE_RE.fullmatch(text)
-    if m:
-        bilibili_cookie = m.group(1).strip()
-        _save_state()
-        await bot.send(event, Message("✅ 已设置B站 Cookie"))
-        return True
+async def _cmd_set_cookie(bot: Bot, event: PrivateMessageEvent, m: re.Match) -> None:
+    global bilibili_cookie
+    bilibili_cookie = m.group("cookie").strip()
+    _save_state()
+    await bot.send(event, Message("✅ 已设置B站 Cookie"))
 
-    # 清除Cookie
-    if text in CMD_CLEAR_COOKIE:
-        bilibili_cookie = ""
-        _save_state()
-        await bot.send(event, Message("🧹 已清除B站 Cookie"))
-        return True
 
-    # 设置清晰度
-    m = CMD_SET_HEIGHT_RE.fullmatch(text)
-    if m:
-        h = int(m.group(1))
-        if h < 0:
-            h = 0
-        max_height = h
-        _save_state()
-        await bot.send(
-            event, Message(f"⏱ 清晰度已设置为 {'不限制' if h == 0 else f'<= {h}p'}")
-        )
-        return True
+async def _cmd_clear_cookie(bot: Bot, event: PrivateMessageEvent, m: re.Match) -> None:
+    global bilibili_cookie
+    bilibili_cookie = ""
+    _save_state()
+    await bot.send(event, Message("🧹 已清除B站 Cookie"))
 
-    # 设置最大大小（MB）
-    m = CMD_SET_MAXSIZE_RE.fullmatch(text)
-    if m:
-        lim = int(m.group(1))
-        if lim < 0:
-            lim = 0
-        max_filesize_mb = lim
-        _save_state()
-        await bot.send(
-            event,
-            Message(f"📦 文件大小限制为 {'不限制' if lim == 0 else f'<= {lim}MB'}"),
-        )
-        return True
 
-    # 设置最大时长（秒）
-    m = CMD_SET_MAXDUR_RE.fullmatch(text)
-    if m:
-        d = int(m.group(1))
-        if d < 0:
-            d = 0
-        max_duration_sec = d
-        _save_state()
-        await bot.send(
-            event,
-            Message(
-                f"⏱ 最大时长已设置为 {'不限制' if d == 0 else f'<= {d} 秒'}"
-            ),
-        )
-        return True
+async def _cmd_set_height(bot: Bot, event: PrivateMessageEvent, m: re.Match) -> None:
+    global max_height
+    h = int(m.group("height"))
+    if h < 0:
+        h = 0
+    max_height = h
+    _save_state()
+    await bot.send(
+        event, Message(f"⏱ 清晰度已设置为 {'不限制' if h == 0 else f'<= {h}p'}")
+    )
 
-    # 查看参数
-    if text in CMD_SHOW_PARAMS:
-        await bot.send(
-            event,
-            Message(
-                f"参数：清晰度<= {max_height or '不限'}；"
-                f"大小<= {str(max_filesize_mb) + 'MB' if max_filesize_mb else '不限'}；"
-                f"最大时长<= {str(max_duration_sec) + '秒' if max_duration_sec else '不限'}；"
-                f"Cookie={'已设置' if bool(bilibili_cookie) else '未设置'}；启用群数={len(enabled_groups)}"
-            ),
-        )
-        return True
 
-    # 设置映射
-    m = CMD_SET_MAPPING_RE.fullmatch(text)
-    if m:
-        virt = m.group(1).strip()
-        real = m.group(2).strip()
-        # 支持带引号路径
-        if (real.startswith('"') and real.endswith('"')) or (real.startswith("'") and real.endswith("'")):
-            real = real[1:-1].strip()
-        # 规范化
-        if not virt.startswith("/"):
-            virt = "/" + virt
-        try:
-            real_p = str(Path(real).resolve())
-        except Exception as e:
-            logger.warning(f"bili2mp4: 映射路径解析失败 raw={real} err={e}")
-            await bot.send(event, Message(f"❌ 路径解析失败: {e}"))
-            return True
+async def _cmd_set_maxsize(bot: Bot, event: PrivateMessageEvent, m: re.Match) -> None:
+    global max_filesize_mb
+    lim = int(m.group("maxsize"))
+    if lim < 0:
+        lim = 0
+    max_filesize_mb = lim
+    _save_state()
+    await bot.send(
+        event,
+        Message(f"📦 文件大小限制为 {'不限制' if lim == 0 else f'<= {lim}MB'}"),
+    )
 
-        # 可选：检查路径是否存在（这里提示并仍允许保存）
-        if not Path(real_p).exists():
-            await bot.send(event, Message(f"⚠️ 目标路径不存在: {real_p}，请确认路径或创建后重试"))
-            # 仍然保存映射以便管理员后续修正；如需强制存在可改为 return True
-            # return True
 
-        path_mappings[virt] = real_p
-        _save_state()
-        logger.info(f"bili2mp4: 已添加映射 {real_p} -> {virt}")
-        await bot.send(event, Message(f"✅ 已映射 {real_p} -> {virt}"))
-        return True
+async def _cmd_set_maxdur(bot: Bot, event: PrivateMessageEvent, m: re.Match) -> None:
+    global max_duration_sec
+    d = int(m.group("maxdur"))
+    if d < 0:
+        d = 0
+    max_duration_sec = d
+    _save_state()
+    await bot.send(
+        event,
+        Message(
+            f"⏱ 最大时长已设置为 {'不限制' if d == 0 else f'<= {d} 秒'}"
+        ),
+    )
 
-    # 删除映射
-    m = CMD_REMOVE_MAPPING_RE.fullmatch(text)
-    if m:
-        virt = m.group(1).strip()
-        if not virt.startswith("/"):
-            virt = "/" + virt
-        if virt in path_mappings:
-            path_mappings.pop(virt, None)
-            _save_state()
-            await bot.send(event, Message(f"🗑 已删除映射 {virt}"))
-        else:
-            await bot.send(event, Message(f"ℹ️ 未找到映射 {virt}"))
-        return True
 
-    # 查看映射
-    if text in CMD_LIST_MAPPINGS:
-        if path_mappings:
-            lines = [f"{virt} -> {real}" for virt, real in path_mappings.items()]
-            await bot.send(event, Message("当前映射：\n" + "\n".join(lines)))
-        else:
-            await bot.send(event, Message("暂无映射"))
-        return True
+async def _cmd_show_params(bot: Bot, event: PrivateMessageEvent, m: re.Match) -> None:
+    await bot.send(
+        event,
+        Message(
+            f"参数：清晰度<= {max_height or '不限'}；"
+            f"大小<= {str(max_filesize_mb) + 'MB' if max_filesize_mb else '不限'}；"
+            f"最大时长<= {str(max_duration_sec) + '秒' if max_duration_sec else '不限'}；"
+            f"Cookie={'已设置' if bool(bilibili_cookie) else '未设置'}；启用群数={len(enabled_groups)}"
+        ),
+    )
+
+
+def _resolve_mapping_target(real: str) -> Tuple[str, bool]:
+    """解析映射的真实路径并检查是否存在，返回 (resolve 后的路径, 是否存在)"""
+    real_p = Path(real).resolve()
+    return str(real_p), real_p.exists()
+
+
+async def _cmd_set_mapping(bot: Bot, event: PrivateMessageEvent, m: re.Match) -> None:
+    virt = m.group("map_virt").strip()
+    real = m.group("map_real").strip()
+    # 支持带引号路径
+    if (real.startswith('"') and real.endswith('"')) or (real.startswith("'") and real.endswith("'")):
+        real = real[1:-1].strip()
+    # 规范化
+    if not virt.startswith("/"):
+        virt = "/" + virt
+    try:
+        real_p, exists = await _run_in_thread(_resolve_mapping_target, real)
+    except Exception as e:
+        logger.warning(f"bili2mp4: 映射路径解析失败 raw={real} err={e}")
+        await bot.send(event, Message(f"❌ 路径解析失败: {e}"))
+        return
 
-    return False
+    # 可选：检查路径是否存在（这里提示并仍允许保存）
+    if not exists:
+        await bot.send(event, Message(f"⚠️ 目标路径不存在: {real_p}，请确认路径或创建后重试"))
+        # 仍然保存映射以便管理员后续修正；如需强制存在可改为 return
+
+    path_mappings[virt] = real_p
+    await _rebuild_mapping_index_async()
+    _save_state()
+    logger.info(f"bili2mp4: 已添加映射 {real_p} -> {virt}")
+    await bot.send(event, Message(f"✅ 已映射 {real_p} -> {virt}"))
+
+
+async def _cmd_remove_mapping(bot: Bot, event: PrivateMessageEvent, m: re.Match) -> None:
+    virt = m.group("rm_virt").strip()
+    if not virt.startswith("/"):
+        virt = "/" + virt
+    if virt in path_mappings:
+        path_mappings.pop(virt, None)
+        await _rebuild_mapping_index_async()
+        _save_state()
+        await bot.send(event, Message(f"🗑 已删除映射 {virt}"))
+    else:
+        await bot.send(event, Message(f"ℹ️ 未找到映射 {virt}"))
+
+
+async def _cmd_list_mappings(bot: Bot, event: PrivateMessageEvent, m: re.Match) -> None:
+    if path_mappings:
+        lines = [f"{virt} -> {real}" for virt, real in path_mappings.items()]
+        await bot.send(event, Message("当前映射：\n" + "\n".join(lines)))
+    else:
+        await bot.send(event, Message("暂无映射"))
+
+
+# _CMD_RE 命名分组 -> 处理函数
+_CMD_HANDLERS = {
+    "enable": _cmd_enable,
+    "disable": _cmd_disable,
+    "list": _cmd_list,
+    "set_cookie": _cmd_set_cookie,
+    "clear_cookie": _cmd_clear_cookie,
+    "set_height": _cmd_set_height,
+    "set_maxsize": _cmd_set_maxsize,
+    "set_maxdur": _cmd_set_maxdur,
+    "show_params": _cmd_show_params,
+    "set_mapping": _cmd_set_mapping,
+    "remove_mapping": _cmd_remove_mapping,
+    "list_mappings": _cmd_list_mappings,
+}
+
+
+async def _handle_command(bot: Bot, event: PrivateMessageEvent, text: str) -> bool:
+    """处理管理员私聊命令，未匹配任何命令时返回 False"""
+    m = _CMD_RE.fullmatch(text)
+    if m is None:
+        return False
+    await _CMD_HANDLERS[m.lastgroup](bot, event, m)
+    return True
 
 
 # =========================
@@ -1078,6 +1623,32 @@ except Exception as e:
     logger.exception(f"bili2mp4: 初始化失败: {e}")
 
 
+driver = get_driver()
+
+
+@driver.on_shutdown
+async def _flush_state_on_shutdown():
+    global _flush_handle
+    if _flush_handle is not None:
+        _flush_handle.cancel()
+        _flush_handle = None
+    # 经由锁写入，等待进行中的写入完成后再落盘最后的修改
+    await _flush_state()
+
+
+@driver.on_shutdown
+async def _shutdown_spawn_pool():
+    _spawn_pool.shutdown(wait=False)
+
+
+@driver.on_shutdown
+async def _close_http_session():
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+
 matcher = on_message(priority=5)
 
 @matcher.handle()
@@ -1101,10 +1672,7 @@ async def _bili2mp4_message_handler(bot: Bot, event: Event):
 
             # 仅超管可执行配置命令（按需调整）
             if sender in (bili_super_admins or []):
-                handled = await _handle_group_command(bot, event, text)
-                if handled:
-                    return
-                handled = await _handle_config_command(bot, event, text)
+                handled = await _handle_command(bot, event, text)
                 if handled:
                     return
                 # 未匹配任何命令，忽略或回复帮助
@@ -1125,26 +1693,12 @@ async def _bili2mp4_message_handler(bot: Bot, event: Event):
             if group_id not in enabled_groups:
                 return
 
-            urls = _extract_bili_urls_from_event(event)
+            urls = await _extract_bili_urls_from_event(event)
             if not urls:
                 return
 
-            # 去重并异步下载发送
+            # 异步下载发送（同一视频的任务在 _download_and_send 内串行）
             for u in urls:
-                if u in _processing:
-                    logger.debug(f"bili2mp4: 链接已在处理队列 {u}")
-                    continue
-                _processing.add(u)
-
-                async def _task_wrapper(bot: Bot, group_id: int, u: str):
-                    try:
-                        await _download_and_send(bot, group_id, u)
-                    finally:
-                        try:
-                            _processing.discard(u)
-                        except Exception:
-                            pass
-
-                asyncio.create_task(_task_wrapper(bot, group_id, u))
+                asyncio.create_task(_download_and_send(bot, group_id, u))
     except Exception as e:
         logger.exception(f"bili2mp4: 消息处理器异常: {e}")